@@ -1,15 +1,43 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
 from werkzeug.utils import secure_filename
+import hashlib
+import json
+import mimetypes
 import os
+import re
 from pathlib import Path
+import sqlite3
 import subprocess
 import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
 from tempfile import NamedTemporaryFile
-from flask import send_file, abort
+from flask import send_file, send_from_directory, abort
 from io import BytesIO
 import threading
-import uuid
 import time
+import uuid
+
+# Imported at module load rather than inside the job: the first conversion
+# should not pay the import cost, and workers skip the per-call sys.modules
+# lookup that a function-local import does.
+from PIL import Image
+
+try:
+    import pyvips
+except ImportError:
+    # libvips is optional; Pillow remains the image-conversion fallback.
+    pyvips = None
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional; the stdlib encoder is the fallback.
+    orjson = None
 
 # Configuration
 UPLOAD_ROOT = Path(__file__).resolve().parent / "uploads"
@@ -39,26 +67,353 @@ SUPPORTED_EXTENSIONS = {
 }
 MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50 MB
 
+# Content types for the formats we emit; anything missing falls back to
+# mimetypes.guess_type at request time.
+MIMETYPES = {
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "bmp": "image/bmp",
+    "mp4": "video/mp4",
+    "avi": "video/x-msvideo",
+    "flv": "video/x-flv",
+    "mov": "video/quicktime",
+    "mp3": "audio/mpeg",
+    "wav": "audio/wav",
+    "3gp": "audio/3gpp",
+    "3gg": "audio/3gpp",
+    "mid": "audio/midi",
+    "midi": "audio/midi",
+}
+UPLOAD_BUFFER_SIZE = 1024 * 1024  # 1 MB write buffer for incoming uploads
+
+# Converted-output cache, keyed by content hash of the source bytes plus the
+# target extension. Re-uploading the same file for the same target becomes a
+# hardlink instead of another ffmpeg/Pillow run.
+CACHE_DIR = UPLOAD_ROOT / "cache"
+CACHE_MAX_ENTRIES = 128  # evicted least-recently-used first (by atime)
+
+# Converted outputs live under one whitelisted root, one directory per job.
+# Downloads are then served with send_from_directory, which both confines
+# paths to this root and gives the front proxy a single location to map for
+# X-Sendfile/X-Accel-Redirect (e.g. nginx "location /converted/ { internal; }").
+CONVERTED_ROOT = UPLOAD_ROOT / "converted"
+
+# Precomputed once at import: rebuilding and sorting the supported list (and
+# re-serializing the same JSON body) on every rejected request was pure
+# constant work on the validation hot path.
+_SUPPORTED_SORTED = tuple(sorted(SUPPORTED_EXTENSIONS))
+_UNSUPPORTED_EXT_BODY = json.dumps({
+    "error": "unsupported_extension",
+    "message": "Unsupported file extension",
+    "supported_extensions": list(_SUPPORTED_SORTED),
+}).encode()
+_UNSUPPORTED_TARGET_BODY = json.dumps({
+    "error": "unsupported_target_extension",
+    "message": "Requested conversion target is not supported",
+    "supported_extensions": list(_SUPPORTED_SORTED),
+}).encode()
+
 
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 
+if orjson is not None:
+    from flask.json.provider import JSONProvider
+
+    class OrjsonProvider(JSONProvider):
+        """jsonify/request.json backed by orjson's C encoder.
+
+        Several times faster than the stdlib encoder, which matters mostly
+        for high-rate /status polling. No call sites change.
+        """
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
+# When running behind nginx/Apache, let the web server transmit downloads with
+# kernel sendfile(2) instead of streaming the bytes through Python.
+# Requires an X-Sendfile / X-Accel-Redirect capable front proxy.
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE", "").lower() in ("1", "true", "yes")
+
+
+# Containers ffmpeg can demux from a non-seekable pipe. mp4/mov usually keep
+# their index (moov atom) at the end of the file, so they must go via disk.
+PIPE_SAFE_SOURCES = {"wav", "mp3", "flv"}
+
+# Bounded worker pool for conversion jobs. Spawning an unchecked thread per
+# upload lets a burst of uploads fork-bomb the server; a pool keeps /upload
+# latency bounded and lets queued jobs drain at the machine's pace. The
+# conversions themselves run in subprocesses (ffmpeg) or GIL-releasing C code
+# (Pillow), so threads are enough — no need for a process pool.
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="convert")
+# ffmpeg is multi-threaded on its own; cap concurrent instances so a queue of
+# videos cannot saturate every core.
+FFMPEG_SLOTS = threading.BoundedSemaphore(2)
+
+# Seconds of ffmpeg silence before the watchdog kills it. A fixed wall-clock
+# timeout either kills legitimate long encodes or lets hung processes linger;
+# idle-based reaping does neither.
+FFMPEG_IDLE_TIMEOUT = 30
+
+# Only the tail of ffmpeg's log is kept for error reporting. Collecting the
+# whole stream let verbose filters/encoders grow the buffer without bound for
+# the lifetime of a job.
+FFMPEG_LOG_TAIL_LINES = 200
+
+# ffmpeg -progress output: bare key=value lines
+_PROGRESS_LINE_RE = re.compile(rb"^[A-Za-z_0-9.]+=")
+
+
+# secure_filename does several regex substitutions per call; uploads tend to
+# reuse a small set of names (retries, re-polls, repeated conversions), so
+# memoize the sanitized result.
+_secure_filename = lru_cache(maxsize=256)(secure_filename)
+
+
+@lru_cache(maxsize=1)
+def _ffmpeg_path():
+    """Resolve the ffmpeg binary once per process instead of per job."""
+    return shutil.which("ffmpeg")
+
+
+def _start_idle_watchdog(proc, last_activity):
+    """Kill proc once it produces no output for FFMPEG_IDLE_TIMEOUT seconds.
+
+    last_activity is a single-element list holding a monotonic timestamp,
+    refreshed by whichever thread is moving bytes for the process. Returns
+    an Event that is set if the watchdog fired.
+    """
+    idle_killed = threading.Event()
+
+    def _watch():
+        while proc.poll() is None:
+            if time.monotonic() - last_activity[0] > FFMPEG_IDLE_TIMEOUT:
+                idle_killed.set()
+                proc.kill()
+                return
+            time.sleep(1)
+
+    threading.Thread(target=_watch, daemon=True).start()
+    return idle_killed
+
+
+def _new_upload_tempfile():
+    # Temp file on the upload filesystem so the final move is a rename, not a
+    # copy. Werkzeug's default form parser would instead spool the part into a
+    # SpooledTemporaryFile that file.save() copies a second time.
+    return NamedTemporaryFile(
+        dir=UPLOAD_ROOT, prefix="incoming-", suffix=".part",
+        delete=False, buffering=UPLOAD_BUFFER_SIZE,
+    )
+
+
+class _FfmpegStdinSink:
+    """File-like wrapper around ffmpeg's stdin that tolerates early exit.
+
+    If ffmpeg dies mid-upload the nonzero return code reports the failure;
+    the remaining upload bytes are simply discarded.
+    """
+
+    def __init__(self, proc, last_activity):
+        self._proc = proc
+        self._last_activity = last_activity
+
+    def write(self, data):
+        try:
+            self._proc.stdin.write(data)
+            self._last_activity[0] = time.monotonic()
+        except (BrokenPipeError, OSError):
+            pass
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+
+def _drain_stderr(proc, lines, last_activity=None):
+    # Keep ffmpeg's stderr pipe drained so it cannot block while we are
+    # feeding stdin. -progress key=value lines only refresh the watchdog
+    # timestamp; everything else is kept for error reporting.
+    for raw in proc.stderr:
+        if last_activity is not None:
+            last_activity[0] = time.monotonic()
+        if _PROGRESS_LINE_RE.match(raw):
+            continue
+        lines.append(raw.decode("utf-8", "replace"))
+
+
+def _pipe_plan(filename, convert_to_raw):
+    """Decide whether this upload can be piped straight into ffmpeg.
+
+    Requires the target format to be known before the file part arrives (the
+    frontend sends convert_to first) and a source container that ffmpeg can
+    read from a pipe. Returns the conversion parameters, or None to fall back
+    to the temp-file path and the regular background job.
+    """
+    if not filename or not convert_to_raw:
+        return None
+    extension = Path(filename).suffix.lstrip('.').lower()
+    convert_to = convert_to_raw.lower().lstrip('.')
+    if extension not in PIPE_SAFE_SOURCES or convert_to not in SUPPORTED_EXTENSIONS:
+        return None
+    if convert_to == extension:
+        # Same-format uploads are a plain copy; no point involving ffmpeg.
+        return None
+    file_type = SUPPORTED_EXTENSIONS[extension]
+    if SUPPORTED_EXTENSIONS[convert_to] != file_type:
+        return None
+    if not _ffmpeg_path():
+        return None
+    # Last check so nothing below can bail out with the slot still held. If
+    # all ffmpeg slots are busy, fall back to disk + queued background job.
+    if not FFMPEG_SLOTS.acquire(blocking=False):
+        return None
+    return {"extension": extension, "convert_to": convert_to, "file_type": file_type}
+
+
+def _begin_file_part(filename, convert_to_raw):
+    """Open a write target for the incoming file part.
+
+    On the pipe fast path the uploaded bytes go straight into a running
+    ffmpeg process and the original file never touches disk; conversion
+    starts while the upload is still in flight.
+    """
+    plan = _pipe_plan(filename, convert_to_raw)
+    if plan is None:
+        tmp = _new_upload_tempfile()
+        preallocated = False
+        expected = request.content_length
+        if expected and hasattr(os, "posix_fallocate"):
+            # Reserve the extents in one syscall instead of growing the file
+            # block by block (fewer metadata writes, less fragmentation).
+            # content_length includes multipart overhead, so this slightly
+            # overestimates; the file is truncated back after the last write.
+            try:
+                os.posix_fallocate(tmp.fileno(), 0, expected)
+                preallocated = True
+            except OSError:
+                pass
+        return {
+            "mode": "disk",
+            "filename": filename,
+            "sink": tmp,
+            "tmp_path": tmp.name,
+            "preallocated": preallocated,
+            "hasher": _upload_hasher(),
+        }
+
+    safe_name = _secure_filename(filename)
+    job_id = uuid.uuid4().hex
+    converted_filename = Path(safe_name).stem + "." + plan["convert_to"]
+    converted_dir = CONVERTED_ROOT / job_id
+    converted_dir.mkdir(parents=True, exist_ok=True)
+    converted_path = converted_dir / converted_filename
+    proc = subprocess.Popen(
+        # Progress goes to stderr with newline-terminated lines so the drain
+        # thread sees activity even while output is otherwise quiet.
+        [_ffmpeg_path(), "-y", "-i", "pipe:0", "-nostats", "-progress", "pipe:2", str(converted_path)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        bufsize=UPLOAD_BUFFER_SIZE,
+    )
+    last_activity = [time.monotonic()]
+    stderr_lines = deque(maxlen=FFMPEG_LOG_TAIL_LINES)
+    threading.Thread(
+        target=_drain_stderr, args=(proc, stderr_lines, last_activity), daemon=True,
+    ).start()
+    idle_killed = _start_idle_watchdog(proc, last_activity)
+
+    _register_job(job_id, Job(
+        status=STATUS_IN_PROGRESS,
+        progress=10,
+        dst_path=str(converted_path),
+        file_type=plan["file_type"],
+        extension=plan["extension"],
+        convert_to=plan["convert_to"],
+        filename=safe_name,
+        converted_filename=converted_filename,
+    ))
+    return {
+        "mode": "pipe",
+        "filename": filename,
+        "sink": _FfmpegStdinSink(proc, last_activity),
+        "job_id": job_id,
+        "proc": proc,
+        "stderr": stderr_lines,
+        "idle_killed": idle_killed,
+        "dst_path": str(converted_path),
+        "hasher": _upload_hasher(),
+    }
+
+
+def _finish_piped_job(job_id, proc, stderr_lines, idle_killed):
+    """Wait for an upload-piped ffmpeg process and record the job outcome."""
+    try:
+        _wait_piped_job(job_id, proc, stderr_lines, idle_killed)
+    finally:
+        FFMPEG_SLOTS.release()
+
+
+def _wait_piped_job(job_id, proc, stderr_lines, idle_killed):
+    job = _get_job(job_id)
+    if job is None:
+        proc.kill()
+        return
+    try:
+        returncode = proc.wait()
+        if idle_killed.is_set():
+            raise RuntimeError(f"ffmpeg idle timeout: no output for {FFMPEG_IDLE_TIMEOUT} s")
+        if returncode != 0:
+            raise RuntimeError("ffmpeg conversion failed: " + "".join(list(stderr_lines)[-20:]))
+        _cache_store(job.content_hash, job.convert_to, job.dst_path)
+        with job.lock:
+            job.status = STATUS_COMPLETED
+            job.progress = 100
+        _persist_completed_job(job_id, job)
+    except Exception as e:
+        proc.kill()
+        with job.lock:
+            job.status = STATUS_FAILED
+            job.error = str(e)
+            job.progress = 100
+
+
+def _abort_upload(part):
+    if part is None:
+        return
+    part["sink"].close()
+    if part["mode"] == "pipe":
+        part["proc"].kill()
+        _remove_job(part["job_id"])
+        FFMPEG_SLOTS.release()
+        # The per-job output directory holds nothing but this partial file.
+        shutil.rmtree(Path(part["dst_path"]).parent, ignore_errors=True)
+    else:
+        try:
+            os.unlink(part["tmp_path"])
+        except OSError:
+            pass
+
 # Status endpoint
 @app.route("/status/<job_id>", methods=["GET"])
 def get_job_status(job_id):
-    with JOBS_LOCK:
-        job = JOBS.get(job_id)
-        if not job:
-            return jsonify({"error": "not_found", "message": "Job not found", "job_id": job_id}), 404
-        return jsonify({
-            "job_id": job_id,
-            "status": job["status"],
-            "progress": job["progress"]
-        })
-
-# Job management
-JOBS = {}  # job_id: {status, progress, src_path, dst_path, error, ...}
-JOBS_LOCK = threading.Lock()
+    job = _find_job(job_id)
+    if not job:
+        return jsonify({"error": "not_found", "message": "Job not found", "job_id": job_id}), 404
+    # Plain attribute loads are atomic in CPython; no lock needed to read.
+    return jsonify({
+        "job_id": job_id,
+        "status": job.status,
+        "progress": job.progress
+    })
 
 # Job statuses
 STATUS_QUEUED = "QUEUED"
@@ -67,6 +422,132 @@ STATUS_COMPLETED = "COMPLETED"
 STATUS_FAILED = "FAILED"
 
 
+@dataclass
+class Job:
+    status: str = STATUS_QUEUED
+    progress: int = 0
+    src_path: str | None = None
+    dst_path: str = ""
+    file_type: str = ""
+    extension: str = ""
+    convert_to: str = ""
+    error: str | None = None
+    filename: str = ""
+    converted_filename: str = ""
+    content_hash: str | None = None
+    # Guards compound writes (status + progress + error). Readers that only
+    # need a single field skip it entirely.
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+# Job registry, sharded so that status polls never queue up behind progress
+# writes from other jobs. The shard locks only guard insert/remove; lookups
+# rely on dict.get being thread-safe under the GIL.
+_JOB_SHARD_COUNT = 16  # power of two
+_JOB_SHARDS = tuple({} for _ in range(_JOB_SHARD_COUNT))
+_JOB_SHARD_LOCKS = tuple(threading.Lock() for _ in range(_JOB_SHARD_COUNT))
+
+
+# Completed jobs are also written to a small sqlite index so finished
+# conversions stay downloadable across server restarts; the in-memory
+# registry alone would lose them.
+JOB_DB_PATH = UPLOAD_ROOT / "jobs.sqlite3"
+
+
+def _job_db():
+    conn = sqlite3.connect(str(JOB_DB_PATH))
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def _init_job_db():
+    conn = _job_db()
+    try:
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS completed_jobs ("
+                " job_id TEXT PRIMARY KEY,"
+                " dst_path TEXT NOT NULL,"
+                " converted_filename TEXT NOT NULL,"
+                " filename TEXT,"
+                " file_type TEXT,"
+                " convert_to TEXT,"
+                " content_hash TEXT)"
+            )
+    finally:
+        conn.close()
+
+
+def _persist_completed_job(job_id, job):
+    try:
+        conn = _job_db()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO completed_jobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, job.dst_path, job.converted_filename, job.filename,
+                     job.file_type, job.convert_to, job.content_hash),
+                )
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass  # persistence is best-effort; the in-memory job still works
+
+
+def _load_completed_job(job_id):
+    try:
+        conn = _job_db()
+        try:
+            row = conn.execute(
+                "SELECT dst_path, converted_filename, filename, file_type,"
+                " convert_to, content_hash FROM completed_jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    if row is None:
+        return None
+    job = Job(
+        status=STATUS_COMPLETED,
+        progress=100,
+        dst_path=row[0],
+        converted_filename=row[1],
+        filename=row[2],
+        file_type=row[3],
+        convert_to=row[4],
+        content_hash=row[5],
+    )
+    _register_job(job_id, job)
+    return job
+
+
+def _find_job(job_id):
+    """Look up a job in memory, falling back to the persistent index."""
+    return _get_job(job_id) or _load_completed_job(job_id)
+
+
+def _shard_index(job_id):
+    return hash(job_id) & (_JOB_SHARD_COUNT - 1)
+
+
+def _register_job(job_id, job):
+    i = _shard_index(job_id)
+    with _JOB_SHARD_LOCKS[i]:
+        _JOB_SHARDS[i][job_id] = job
+
+
+def _get_job(job_id):
+    return _JOB_SHARDS[_shard_index(job_id)].get(job_id)
+
+
+def _remove_job(job_id):
+    i = _shard_index(job_id)
+    with _JOB_SHARD_LOCKS[i]:
+        _JOB_SHARDS[i].pop(job_id, None)
+
+
 @app.after_request
 def add_cors_headers(response):
     # Allow simple CORS for local development (adjust for production)
@@ -75,8 +556,75 @@ def add_cors_headers(response):
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization'
     return response
 
-# Ensure upload root exists
+def _sweep_stale_uploads():
+    """Remove leftover upload temp files from crashed or killed runs.
+
+    Aborted requests unlink their own temp file, but a hard crash mid-upload
+    leaves incoming-*.part behind. Anything older than an hour cannot belong
+    to a live upload, so it is safe to reclaim at startup.
+    """
+    cutoff = time.time() - 3600
+    for part in UPLOAD_ROOT.glob("incoming-*.part"):
+        try:
+            if part.stat().st_mtime < cutoff:
+                part.unlink()
+        except OSError:
+            pass
+
+
+# Ensure upload root, cache, converted root and job index exist
 UPLOAD_ROOT.mkdir(parents=True, exist_ok=True)
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+CONVERTED_ROOT.mkdir(parents=True, exist_ok=True)
+_init_job_db()
+_sweep_stale_uploads()
+
+
+def _upload_hasher():
+    # blake2b is the fastest keyed hash in the stdlib; hashing happens inline
+    # while the upload streams, so it costs no extra pass over the file.
+    return hashlib.blake2b(digest_size=32)
+
+
+def _cache_path(content_hash, convert_to):
+    return CACHE_DIR / f"{content_hash}.{convert_to}"
+
+
+def _cache_lookup(content_hash, convert_to, dst_path):
+    """Hardlink a cached conversion into place. Returns True on a hit."""
+    cache_path = _cache_path(content_hash, convert_to)
+    try:
+        if os.path.exists(dst_path):
+            os.unlink(dst_path)
+        os.link(cache_path, dst_path)
+    except OSError:
+        return False
+    return True
+
+
+def _cache_store(content_hash, convert_to, dst_path):
+    """Publish a converted output into the cache (hardlink, no copy)."""
+    if not content_hash:
+        return
+    try:
+        os.link(dst_path, _cache_path(content_hash, convert_to))
+    except FileExistsError:
+        pass
+    except OSError:
+        return
+    _evict_cache()
+
+
+def _evict_cache():
+    try:
+        entries = sorted(CACHE_DIR.iterdir(), key=lambda p: p.stat().st_atime)
+    except OSError:
+        return
+    for stale in entries[:-CACHE_MAX_ENTRIES]:
+        try:
+            os.unlink(stale)
+        except OSError:
+            pass
 
 
 @app.route("/", methods=["GET"])
@@ -87,59 +635,168 @@ def index():
 
 @app.route("/upload", methods=["POST"])
 def upload_file():
-    # Expect multipart/form-data with fields: file (file) and convert_to (target extension)
-    if "file" not in request.files:
+    # Expect multipart/form-data with fields: convert_to (target extension)
+    # and file (file), in that order. The body is decoded incrementally so
+    # file parts either pipe straight into ffmpeg or stream to disk without
+    # the buffering and copy that request.files/file.save() would do.
+    if request.content_length and request.content_length > MAX_CONTENT_LENGTH:
+        abort(413)
+    ctype, options = parse_options_header(request.content_type or "")
+    boundary = options.get("boundary", "")
+    if ctype != "multipart/form-data" or not boundary:
+        return jsonify({"error": "missing_file", "message": "No file part in the request"}), 400
+
+    decoder = MultipartDecoder(boundary.encode())
+
+    def _iter_events():
+        while True:
+            chunk = request.stream.read(UPLOAD_BUFFER_SIZE)
+            decoder.receive_data(chunk if chunk else None)
+            while True:
+                event = decoder.next_event()
+                if isinstance(event, NeedData):
+                    break
+                yield event
+                if isinstance(event, Epilogue):
+                    return
+            if not chunk:
+                raise ValueError("incomplete multipart body")
+
+    form = {}
+    part = None          # the received "file" part
+    current_field = None
+    field_chunks = []
+    sink = None          # active write target for file-part data
+
+    try:
+        for event in _iter_events():
+            if isinstance(event, Field):
+                current_field = event.name
+                field_chunks = []
+            elif isinstance(event, File):
+                current_field = None
+                if event.name == "file" and event.filename and part is None:
+                    part = _begin_file_part(event.filename, form.get("convert_to"))
+                    sink = part["sink"]
+                else:
+                    sink = None  # unknown or duplicate file parts are discarded
+            elif isinstance(event, Data):
+                if current_field is not None:
+                    field_chunks.append(event.data)
+                    if not event.more_data:
+                        form[current_field] = b"".join(field_chunks).decode("utf-8", "replace")
+                        current_field = None
+                elif sink is not None and event.data:
+                    sink.write(event.data)
+                    part["hasher"].update(event.data)
+    except ValueError:
+        _abort_upload(part)
+        return jsonify({"error": "malformed_multipart", "message": "Could not parse multipart body"}), 400
+    except Exception:
+        _abort_upload(part)
+        raise
+
+    if part is None:
         return jsonify({"error": "missing_file", "message": "No file part in the request"}), 400
 
-    file = request.files["file"]
-    convert_to_raw = request.form.get("convert_to")
+    if part.get("preallocated"):
+        # Drop the preallocation overshoot so the file ends at the last byte
+        # actually written.
+        part["sink"].truncate()
+    part["sink"].close()
+    if part["mode"] == "pipe":
+        job = _get_job(part["job_id"])
+        if job is not None:
+            job.content_hash = part["hasher"].hexdigest()
+        # ffmpeg already has the whole input; just wait for it in the
+        # background. A plain thread rather than the pool: the waiter releases
+        # an ffmpeg slot, so it must not queue behind jobs waiting for one.
+        threading.Thread(
+            target=_finish_piped_job,
+            args=(part["job_id"], part["proc"], part["stderr"], part["idle_killed"]),
+            daemon=True,
+        ).start()
+        return jsonify({
+            "job_id": part["job_id"],
+            "status": STATUS_IN_PROGRESS,
+            "message": "Conversion started."
+        }), 202
+    return _finish_disk_upload(form, part)
+
+
+def _finish_disk_upload(form, part):
+    try:
+        return _validate_and_register(form, part)
+    finally:
+        # No-op after a successful rename; removes the temp file otherwise.
+        try:
+            os.unlink(part["tmp_path"])
+        except OSError:
+            pass
+
+
+def _validate_and_register(form, part):
+    file_name = part["filename"]
+    convert_to_raw = form.get("convert_to")
     if not convert_to_raw:
         return jsonify({"error": "missing_convert_to", "message": "No target format (convert_to) provided"}), 400
     convert_to = convert_to_raw.lower().lstrip('.')
 
     # Infer extension from filename
-    extension = Path(file.filename).suffix.lstrip('.').lower()
+    extension = Path(file_name).suffix.lstrip('.').lower()
     if not extension:
         return jsonify({"error": "missing_extension", "message": "Could not determine file extension from filename."}), 400
     if extension not in SUPPORTED_EXTENSIONS:
-        return jsonify({"error": "unsupported_extension", "message": "Unsupported file extension", "supported_extensions": sorted(list(SUPPORTED_EXTENSIONS.keys()))}), 400
+        return Response(_UNSUPPORTED_EXT_BODY, status=400, mimetype="application/json")
     if convert_to not in SUPPORTED_EXTENSIONS:
-        return jsonify({"error": "unsupported_target_extension", "message": "Requested conversion target is not supported", "supported_extensions": sorted(list(SUPPORTED_EXTENSIONS.keys()))}), 400
+        return Response(_UNSUPPORTED_TARGET_BODY, status=400, mimetype="application/json")
 
     file_type = SUPPORTED_EXTENSIONS[extension]
     target_type = SUPPORTED_EXTENSIONS[convert_to]
     if target_type != file_type:
         return jsonify({"error": "mismatched_target_type", "message": "Requested target extension is not the same media type as the uploaded file"}), 400
 
-    if file.filename == "":
-        return jsonify({"error": "empty_filename", "message": "Uploaded file has no filename"}), 400
-
-    filename = secure_filename(file.filename)
+    filename = _secure_filename(file_name)
     dest_dir = UPLOAD_ROOT / file_type
     dest_dir.mkdir(parents=True, exist_ok=True)
     save_path = dest_dir / filename
-    file.save(save_path)
+    # The upload is already on disk in a temp file on the same filesystem;
+    # moving it into place is a rename, not a copy.
+    os.replace(part["tmp_path"], save_path)
 
     # Generate job_id and store job info
     job_id = uuid.uuid4().hex
     converted_filename = Path(filename).stem + "." + convert_to
-    converted_path = dest_dir / converted_filename
-    with JOBS_LOCK:
-        JOBS[job_id] = {
-            "status": STATUS_QUEUED,
-            "progress": 0,
-            "src_path": str(save_path),
-            "dst_path": str(converted_path),
-            "file_type": file_type,
-            "extension": extension,
-            "convert_to": convert_to,
-            "error": None,
-            "filename": filename,
-            "converted_filename": converted_filename
-        }
+    converted_dir = CONVERTED_ROOT / job_id
+    converted_dir.mkdir(parents=True, exist_ok=True)
+    converted_path = converted_dir / converted_filename
+    job = Job(
+        src_path=str(save_path),
+        dst_path=str(converted_path),
+        file_type=file_type,
+        extension=extension,
+        convert_to=convert_to,
+        filename=filename,
+        converted_filename=converted_filename,
+        content_hash=part["hasher"].hexdigest(),
+    )
+
+    # Identical bytes already converted to this target? Hardlink the cached
+    # output and skip the worker entirely.
+    if _cache_lookup(job.content_hash, convert_to, converted_path):
+        job.status = STATUS_COMPLETED
+        job.progress = 100
+        _register_job(job_id, job)
+        _persist_completed_job(job_id, job)
+        return jsonify({
+            "job_id": job_id,
+            "status": STATUS_COMPLETED,
+            "message": "Conversion served from cache."
+        }), 202
 
-    # Start background conversion
-    threading.Thread(target=process_conversion_job, args=(job_id,), daemon=True).start()
+    _register_job(job_id, job)
+    # Queue the conversion on the bounded worker pool
+    EXECUTOR.submit(process_conversion_job, job_id)
 
     return jsonify({
         "job_id": job_id,
@@ -147,108 +804,270 @@ def upload_file():
         "message": "Conversion started."
     }), 202
 
+def _fast_copy(src_path, dst_path):
+    """Copy a file without moving its bytes through Python.
+
+    cp --reflink=auto shares extents in O(1) on CoW filesystems (Btrfs, XFS)
+    and silently degrades to a plain copy elsewhere. Without cp, os.sendfile
+    moves the bytes kernel-side with no userspace buffer; shutil.copyfile is
+    the portable last resort.
+    """
+    try:
+        subprocess.run(
+            ["cp", "--reflink=auto", str(src_path), str(dst_path)],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        return
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    if hasattr(os, "sendfile"):
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            size = os.fstat(src.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                pass  # e.g. a filesystem sendfile cannot serve; copy below
+            else:
+                if offset >= size:
+                    return
+    shutil.copyfile(src_path, dst_path)
+
+
+@lru_cache(maxsize=16)
+def _white_background(size):
+    """Shared white canvas per image size; callers must .copy() before pasting.
+
+    Batches of screenshots/photos tend to share dimensions, so this skips an
+    Image.new allocation and fill per converted image.
+    """
+    return Image.new("RGB", size, (255, 255, 255))
+
+
+def _convert_image(src_path, dst_path, convert_to):
+    """Convert an image, preferring libvips when it is available.
+
+    libvips streams the image in tiles with SIMD-accelerated kernels instead
+    of decoding the whole frame into memory, which is typically several times
+    faster than Pillow on large JPEG/PNG inputs. Formats vips cannot handle
+    (or a missing pyvips) fall back to the Pillow path.
+    """
+    if pyvips is not None:
+        try:
+            img = pyvips.Image.new_from_file(str(src_path), access="sequential")
+            if convert_to in ("jpg", "jpeg") and img.hasalpha():
+                img = img.flatten(background=[255, 255, 255])
+            img.write_to_file(str(dst_path))
+            return
+        except pyvips.Error:
+            pass
+
+    with Image.open(src_path) as img:
+        if convert_to in ("jpg", "jpeg") and img.mode in ("RGBA", "LA"):
+            background = _white_background(img.size).copy()
+            background.paste(img, mask=img.split()[3])
+            background.save(dst_path, format="JPEG")
+        else:
+            img.save(dst_path)
+
+
+# Matches ffmpeg's "Duration: HH:MM:SS.cc" line in its input probe output
+_DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+)\.(\d+)")
+
+# Hardware H.264 encoders in preference order: NVIDIA, Intel QuickSync, VAAPI
+_HW_ENCODER_PREFERENCE = ("h264_nvenc", "h264_qsv", "h264_vaapi")
+
+
+@lru_cache(maxsize=1)
+def _hw_h264_encoder():
+    """Probe ffmpeg once for a usable hardware H.264 encoder.
+
+    Returns the encoder name, or None when only software encoding is built
+    in. Cached for the process lifetime so the probe runs at most once.
+    """
+    ffmpeg = _ffmpeg_path()
+    if not ffmpeg:
+        return None
+    try:
+        out = subprocess.run(
+            [ffmpeg, "-hide_banner", "-encoders"],
+            capture_output=True, text=True, timeout=10,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    for encoder in _HW_ENCODER_PREFERENCE:
+        if encoder in out:
+            return encoder
+    return None
+
+
+def _run_ffmpeg_with_progress(src_path, dst_path, job, input_args=(), output_args=()):
+    """Run ffmpeg and feed its real progress into the job.
+
+    ffmpeg reports out_time_ms on the -progress stream; combined with the
+    input duration scraped from the probe log this gives an actual percentage
+    instead of simulated steps.
+    """
+    cmd = [
+        _ffmpeg_path(), "-y",
+        *input_args,
+        "-i", str(src_path),
+        *output_args,
+        "-nostats", "-progress", "pipe:1",
+        str(dst_path),
+    ]
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
+    )
+    duration_ms = [None]
+    stderr_lines = deque(maxlen=FFMPEG_LOG_TAIL_LINES)
+    last_activity = [time.monotonic()]
+
+    def _read_stderr():
+        for line in proc.stderr:
+            last_activity[0] = time.monotonic()
+            stderr_lines.append(line)
+            if duration_ms[0] is None:
+                m = _DURATION_RE.search(line)
+                if m:
+                    h, minutes, s, cs = (int(g) for g in m.groups())
+                    duration_ms[0] = ((h * 60 + minutes) * 60 + s) * 1000 + cs * 10
+
+    reader = threading.Thread(target=_read_stderr, daemon=True)
+    reader.start()
+    idle_killed = _start_idle_watchdog(proc, last_activity)
+    try:
+        for line in proc.stdout:
+            last_activity[0] = time.monotonic()
+            # out_time_ms is microseconds despite the name
+            if line.startswith("out_time_ms=") and duration_ms[0]:
+                try:
+                    out_ms = int(line.split("=", 1)[1]) // 1000
+                except ValueError:
+                    continue
+                percent = min(99, int(out_ms * 100 / duration_ms[0]))
+                with job.lock:
+                    job.progress = max(job.progress, percent)
+        returncode = proc.wait()
+    except Exception:
+        proc.kill()
+        raise
+    reader.join(timeout=5)
+    if idle_killed.is_set():
+        raise RuntimeError(f"ffmpeg idle timeout: no output for {FFMPEG_IDLE_TIMEOUT} s")
+    if returncode != 0:
+        raise RuntimeError("ffmpeg conversion failed: " + "".join(stderr_lines))
+
+
 # Background job processor
 def process_conversion_job(job_id):
-    with JOBS_LOCK:
-        job = JOBS.get(job_id)
-        if not job:
-            return
-        job["status"] = STATUS_IN_PROGRESS
-        job["progress"] = 10
+    job = _get_job(job_id)
+    if not job:
+        return
+    with job.lock:
+        job.status = STATUS_IN_PROGRESS
+        job.progress = 10
 
     try:
-        src_path = job["src_path"]
-        dst_path = job["dst_path"]
-        file_type = job["file_type"]
-        convert_to = job["convert_to"]
-        extension = job["extension"]
-
-        # Simulate progress
-        for p in [20, 40]:
-            time.sleep(0.2)
-            with JOBS_LOCK:
-                job["progress"] = p
+        src_path = job.src_path
+        dst_path = job.dst_path
+        file_type = job.file_type
+        convert_to = job.convert_to
+        extension = job.extension
 
         if convert_to == extension:
-            # No conversion needed, just copy
-            shutil.copyfile(src_path, dst_path)
+            # No conversion needed, just copy (reflink/sendfile when possible)
+            _fast_copy(src_path, dst_path)
         elif file_type == "image":
-            from PIL import Image
-            with Image.open(src_path) as img:
-                if convert_to in ("jpg", "jpeg") and img.mode in ("RGBA", "LA"):
-                    background = Image.new("RGB", img.size, (255, 255, 255))
-                    background.paste(img, mask=img.split()[3])
-                    background.save(dst_path, format="JPEG")
-                else:
-                    img.save(dst_path)
+            _convert_image(src_path, dst_path, convert_to)
         elif file_type in ("audio", "video"):
-            if not shutil.which("ffmpeg"):
+            if not _ffmpeg_path():
                 raise RuntimeError("ffmpeg is required for audio/video conversion but was not found on the system PATH.")
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-i",
-                str(src_path),
-                str(dst_path),
-            ]
-            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=120)
-            if proc.returncode != 0:
-                raise RuntimeError(f"ffmpeg conversion failed: {proc.stderr}")
+            encoder = _hw_h264_encoder() if file_type == "video" else None
+            with FFMPEG_SLOTS:
+                if encoder:
+                    try:
+                        # -hwaccel auto also offloads decode when the driver
+                        # supports it, and quietly decodes in software if not.
+                        _run_ffmpeg_with_progress(
+                            src_path, dst_path, job,
+                            input_args=("-hwaccel", "auto"),
+                            output_args=("-c:v", encoder, "-c:a", "aac"),
+                        )
+                    except RuntimeError:
+                        # Encoder exists but the hardware refused (no GPU,
+                        # exhausted sessions, ...): retry in software once.
+                        _run_ffmpeg_with_progress(src_path, dst_path, job)
+                else:
+                    _run_ffmpeg_with_progress(src_path, dst_path, job)
         else:
             raise RuntimeError(f"Conversion for type {file_type} is not supported.")
 
-        with JOBS_LOCK:
-            job["status"] = STATUS_COMPLETED
-            job["progress"] = 100
+        _cache_store(job.content_hash, convert_to, dst_path)
+        with job.lock:
+            job.status = STATUS_COMPLETED
+            job.progress = 100
+        _persist_completed_job(job_id, job)
     except Exception as e:
-        with JOBS_LOCK:
-            job["status"] = STATUS_FAILED
-            job["error"] = str(e)
-            job["progress"] = 100
+        with job.lock:
+            job.status = STATUS_FAILED
+            job.error = str(e)
+            job.progress = 100
 
 
 
 # Download endpoint
 @app.route("/download/<job_id>", methods=["GET"])
 def download_converted_file(job_id):
-    with JOBS_LOCK:
-        job = JOBS.get(job_id)
-        if not job:
-            return jsonify({"error": "not_found", "message": "Job not found", "job_id": job_id}), 404
-        if job["status"] != STATUS_COMPLETED:
-            return jsonify({"error": "not_ready", "message": f"Job status is {job['status']}, file not available yet.", "job_id": job_id}), 400
-        dst_path = job["dst_path"]
-        converted_filename = job["converted_filename"]
-        # Guess mimetype from extension (basic)
-        ext = Path(converted_filename).suffix.lower().lstrip('.')
-        mimetype = None
-        if ext in ("jpg", "jpeg"):
-            mimetype = "image/jpeg"
-        elif ext == "png":
-            mimetype = "image/png"
-        elif ext == "bmp":
-            mimetype = "image/bmp"
-        elif ext == "mp4":
-            mimetype = "video/mp4"
-        elif ext == "avi":
-            mimetype = "video/x-msvideo"
-        elif ext == "flv":
-            mimetype = "video/x-flv"
-        elif ext == "mov":
-            mimetype = "video/quicktime"
-        elif ext == "mp3":
-            mimetype = "audio/mpeg"
-        elif ext == "wav":
-            mimetype = "audio/wav"
-        elif ext in ("3gp", "3gg"):
-            mimetype = "audio/3gpp"
-        elif ext in ("mid", "midi"):
-            mimetype = "audio/midi"
-        # else: leave as None for Flask to guess
+    job = _find_job(job_id)
+    if not job:
+        return jsonify({"error": "not_found", "message": "Job not found", "job_id": job_id}), 404
+    if job.status != STATUS_COMPLETED:
+        return jsonify({"error": "not_ready", "message": f"Job status is {job.status}, file not available yet.", "job_id": job_id}), 400
+    dst_path = job.dst_path
+    converted_filename = job.converted_filename
+    # Table lookup, then stdlib guess; None lets Flask pick a default
+    ext = Path(converted_filename).suffix.lower().lstrip('.')
+    mimetype = MIMETYPES.get(ext) or mimetypes.guess_type(converted_filename)[0]
+    send_kwargs = dict(
+        as_attachment=True,
+        download_name=converted_filename,
+        mimetype=mimetype,
+        # Enables If-None-Match/If-Modified-Since (304) and Range requests.
+        conditional=True,
+        # Content hash makes a strong validator; True falls back to
+        # werkzeug's mtime-based tag for jobs restored without one.
+        etag=job.content_hash or True,
+        max_age=86400,
+    )
     try:
-        return send_file(dst_path, as_attachment=True, download_name=converted_filename, mimetype=mimetype)
+        send_kwargs["last_modified"] = os.path.getmtime(dst_path)
+        # Serving relative to the whitelisted converted root keeps werkzeug's
+        # path checks and the X-Sendfile fast path on a single known location.
+        relative = Path(dst_path).relative_to(CONVERTED_ROOT)
+        resp = send_from_directory(CONVERTED_ROOT, str(relative), **send_kwargs)
+    except ValueError:
+        # Jobs recorded before outputs moved under the converted root.
+        try:
+            resp = send_file(dst_path, **send_kwargs)
+        except Exception as e:
+            return jsonify({"error": "send_failed", "message": str(e)}), 500
     except Exception as e:
         return jsonify({"error": "send_failed", "message": str(e)}), 500
+    # Outputs are content-addressed via the ETag, so clients and CDNs can
+    # cache them aggressively; a changed file would change the tag.
+    resp.headers["Cache-Control"] = "public, max-age=86400, immutable"
+    return resp
 
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=5000, debug=True)
\ No newline at end of file
+    # Development only. The werkzeug dev server handles one request at a
+    # time; production runs through gunicorn (see wsgi.py / Procfile).
+    app.run(host="127.0.0.1", port=5000)
\ No newline at end of file
@@ -0,0 +1,12 @@
+"""WSGI entry point for production servers.
+
+Run with gunicorn's threaded worker so /status polls and downloads are not
+serialized behind uploads and conversions:
+
+    gunicorn -k gthread -w 1 --threads 16 --timeout 180 wsgi:app
+
+Keep a single worker process: the job registry and the ffmpeg slot limits
+live in process memory, so extra workers would only see each other's
+completed jobs (via the sqlite index), not in-flight ones.
+"""
+from app import app  # noqa: F401